@@ -169,10 +169,9 @@ class ProcessButton (tkinter.Button):
         
         self.logln('Beginning data collection from WormBase (this could take a bit)')
 
-        # This loop contains all of the WormBase API interactions
+        # This loop builds one WormData object per requested ID. Construction
+        # is cheap; none of the API calls happen yet
         for id in cleanIds:
-            self.log(id + ' ... ')
-
             if not noDbMode and id.startswith("XLOC"):
                 wormbaseIDs = self.csvDatabase.get(id)['gene'].split(',')
                 xlocMode = True
@@ -181,17 +180,17 @@ class ProcessButton (tkinter.Button):
                 xlocMode = False
 
             for i in wormbaseIDs:
-                # Create the WormData object. The object populates its own data in its constructor
-
                 if xlocMode:
                     d = WormCSV.WormData(id, i, self.csvDatabase)
                     d.data['db_id'] = id
                 else:
                     d = WormCSV.WormData(None, i, None)
-                    
+
                 allWormDatas.append(d)
-            
-            self.logln('finished')
+
+        # All of the WormBase API interactions happen here. The whole batch of
+        # WormData objects is populated concurrently instead of one at a time
+        WormCSV.populateAll(allWormDatas)
 
         self.logln('Finished collecting data from WormBase')
 
@@ -1,7 +1,12 @@
 import csv
 import requests
-import json
+import os
+import shelve
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.util.retry import Retry
 
 """The WormCSV module holds classes that make up the infrastructure of the data layer in WormBait
 
@@ -13,41 +18,192 @@ CuffLink database file), collecting data (from the WormBase RESTful API), and wr
 Christopher Anna, 2/18/2016
 """
 
+try:
+    import orjson
+
+    def parseJson (content):
+        """Parses raw response bytes into JSON with orjson
+
+        orjson is several times faster than the stdlib json module on the
+        deeply nested payloads WormBase returns (gene_models and the ortholog
+        tables in particular), and it holds the GIL for less time, which keeps
+        the concurrent fetches flowing.
+        """
+        return orjson.loads(content)
+except ImportError:
+    import json
+
+    def parseJson (content):
+        """Parses raw response bytes into JSON with the stdlib json module
+
+        Fallback for environments without orjson installed. Slower, but the
+        results are identical.
+        """
+        return json.loads(content)
+
+CACHE_PATH = os.path.expanduser('~/.wormbait_cache')
+"""Where the persistent WormBase response cache lives on disk"""
+
+CACHE_TTL = 60 * 60 * 24 * 30
+"""How long a cached WormBase response stays valid, in seconds (30 days)"""
+
+cacheEnabled = True
+"""Set to False to bypass the response cache and fetch fresh data every time"""
+
+try:
+    diskCache = shelve.open(CACHE_PATH)
+except Exception:
+    # If the cache file cannot be opened (permissions, corruption, ...) we
+    # quietly fall back to an in-memory dict. Runs still work, they just
+    # cannot reuse responses from previous runs
+    diskCache = {}
+
+memoryCache = {}
+"""In-process memo of responses already fetched (or loaded from disk) this run"""
+
+cacheLock = threading.Lock()
+"""Guards both caches, since fetches run on several threads at once"""
+
+def cacheGet (url):
+    """Returns the cached response for `url`, or None on a miss
+
+    The in-process memo is checked first, then the on-disk cache. Disk
+    entries older than CACHE_TTL are treated as misses, so a stale cache
+    cannot hide updated WormBase data forever.
+    """
+    if not cacheEnabled:
+        return None
+    with cacheLock:
+        if url in memoryCache:
+            return memoryCache[url]
+        entry = diskCache.get(url)
+        if entry and time.time() - entry['time'] < CACHE_TTL:
+            memoryCache[url] = entry['data']
+            return entry['data']
+        return None
+
+def cachePut (url, data):
+    """Stores a response in both the in-process memo and the on-disk cache"""
+    if not cacheEnabled:
+        return
+    with cacheLock:
+        memoryCache[url] = data
+        diskCache[url] = {'time': time.time(), 'data': data}
+
+def buildSession ():
+    """Builds the shared HTTP session used for all WormBase API calls
+
+    A single requests.Session keeps the underlying connections to the WormBase
+    server alive between calls, so we only pay for the TCP handshake once
+    instead of once per request. Since one WormBait run makes many requests
+    against the same couple of hosts, this saves a round trip on nearly every
+    fetch. The session also retries transiently failed requests a few times
+    and asks WormBase to gzip its (very compressible) JSON responses.
+    """
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.3)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # These defaults ride along on every request made through the session,
+    # so fetch() no longer merges a headers dict into each call. 'Accept' is
+    # the semantically right way to ask a GET endpoint for JSON (the old code
+    # sent 'Content-Type', which describes a request body we never have)
+    session.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip'})
+    return session
+
+executor = ThreadPoolExecutor(max_workers=16)
+"""The shared thread pool used to run independent WormBase API calls concurrently
+
+The API calls WormBait makes are almost entirely waiting on the network, so
+running them on worker threads lets several round trips overlap instead of
+paying for each one in sequence.
+"""
+
+def populateAll (worms, concurrency=32):
+    """Populates a whole batch of WormData objects concurrently
+
+    The genes in a run are completely independent of one another, so there is
+    no reason to wait for one WormData to finish its API calls before starting
+    the next. This driver populates up to `concurrency` genes at a time on a
+    dedicated pool; the individual API calls still flow through the shared
+    `executor` pool, which caps the total number of in-flight requests so we
+    do not hammer the WormBase server.
+
+    Arguments:
+    worms -- the list of WormData objects to populate
+    concurrency -- the maximum number of genes populated at once
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as genePool:
+        list(genePool.map(lambda w: w.populate(), worms))
+
 class CuffLinkDatabase ():
     """ An object representing the data in a CuffLink output file"""
 
     def __init__ (self, file):
         """Constructs a CuffLinkDatabase object.
 
-        The constructor reads a CSV file containing the results of a CuffLinks
-        run. The csv library is used to quickly and efficiently turn these
-        results into a dicionary. It is extremely important that headers
-        are the first row of this file!
+        The constructor scans a CSV file containing the results of a CuffLinks
+        run and records where each row lives in the file; the rows themselves
+        are only parsed when they are actually asked for through get(). It is
+        extremely important that headers are the first row of this file!
 
         Arguments:
         file -- the CSV file from which to read data
         """
         
         self.CSVFile = file
-        self.data = {}
-
-        reader = csv.reader(self.CSVFile, delimiter = ',', quotechar='"')
-
-        headers = next(reader)
-        
-        for row in reader:
-            self.data[row[0]] = dict(list(zip(headers,row)))
+        self.path = getattr(file, 'name', None)
+
+        headerLine = file.readline()
+        self.headers = next(csv.reader([headerLine], delimiter = ',', quotechar='"'))
+
+        # Rather than materializing every column of every row into memory, we
+        # make a single pass over the file recording the byte offset at which
+        # each row starts, keyed by the DB ID in the first column. Rows are
+        # parsed on demand in get(), so memory stays proportional to the
+        # number of rows no matter how wide the CuffLinks output is
+        self.offsets = {}
+        offset = file.tell()
+        line = file.readline()
+        while line:
+            dbId = line.split(',', 1)[0].strip().strip('"')
+            self.offsets[dbId] = offset
+            offset = file.tell()
+            line = file.readline()
+
+        self.rowCache = {}
+        self.fileLock = threading.Lock()
 
     def get (self, dbId):
-        """Returns all the data corresponding to a single row in the CuffLink DB file. Returns a dict of this information"""
-        if dbId in self.data:
-            return self.data[dbId]
-        else:
+        """Returns all the data corresponding to a single row in the CuffLink DB file. Returns a dict of this information
+
+        The row is located by its recorded byte offset and parsed on first
+        access; parsed rows are kept in a small cache so repeated lookups of
+        the same DB ID stay cheap. The file handle given to the constructor
+        may have been closed by the caller, in which case it is quietly
+        reopened from its original path. Access to the handle is serialized
+        because populate() calls arrive from several threads at once.
+        """
+        if dbId not in self.offsets:
             return None
 
+        with self.fileLock:
+            if dbId in self.rowCache:
+                return self.rowCache[dbId]
+
+            if self.CSVFile.closed:
+                self.CSVFile = open(self.path, 'r')
+
+            self.CSVFile.seek(self.offsets[dbId])
+            values = next(csv.reader([self.CSVFile.readline()], delimiter = ',', quotechar='"'))
+            row = dict(zip(self.headers, values))
+            self.rowCache[dbId] = row
+            return row
+
     def getAll (self):
         """Returns ALL the data stored in the CuffLink DB file. Use with caution!"""
-        return self.data
+        return dict((dbId, self.get(dbId)) for dbId in self.offsets)
 
 
 class OutputCSV ():
@@ -74,31 +230,36 @@ class OutputCSV ():
     def write (self, listOfWormDatas):
         """Writes all the data in argument `listOfWormDatas` to the file"""
 
-        exclusivelyWBIds = True
-        for w in listOfWormDatas:
-            if exclusivelyWBIds and w.describe() and 'db_id' in w.describe() and w.describe()['db_id'].startswith('XLOC'):
-                exclusivelyWBIds = False
+        # The db_id and up/down columns only make sense when at least one
+        # entry came from an XLOC row in the CuffLink file. any() stops at
+        # the first such entry, and the walrus keeps it to a single
+        # describe() call per item instead of three
+        hasXloc = any((d := w.describe()) and d.get('db_id', '').startswith('XLOC')
+                      for w in listOfWormDatas)
 
-        if exclusivelyWBIds:
+        if not hasXloc:
             self.headers.remove('db_id')
             self.headers.remove('up/down')
 
-        # This method requires a little kludgy glue to work on both Python2
-        # and Python3. On v2, the file should be opened in binary write mode
-        # On v3, this will cause exceptions. Unfortunately the 2to3 program
-        # doesn't pick up on this, so I make the fix here
+        # Each WormData projects itself into a tuple in header order, so the
+        # C-implemented csv module can emit the whole batch in a single
+        # writerows call with no per-header dict lookups at write time
+        rows = [wormData.as_row(self.headers) for wormData in listOfWormDatas]
+
+        # Opening the file still requires a little kludgy glue to work on
+        # both Python2 and Python3. On v2, the file should be opened in
+        # binary write mode. On v3, this will cause exceptions. Unfortunately
+        # the 2to3 program doesn't pick up on this, so the version check
+        # stays, but only around open()
         if sys.version_info >= (3,0,0):
-           with open(self.path, 'w') as file:
-                writer = csv.DictWriter(file, fieldnames=self.headers)
-                writer.writeheader()
-                for wormData in listOfWormDatas:
-                    writer.writerow(wormData.describe())
+            file = open(self.path, 'w', newline='', encoding='utf-8')
         else:
-            with open(self.path, 'wb') as file:
-                writer = csv.DictWriter(file, fieldnames=self.headers)
-                writer.writeheader()
-                for wormData in listOfWormDatas:
-                    writer.writerow(wormData.describe())
+            file = open(self.path, 'wb')
+
+        with file:
+            writer = csv.writer(file)
+            writer.writerow(self.headers)
+            writer.writerows(rows)
         
             
 
@@ -111,21 +272,25 @@ class WormData ():
     and they are populated one-by-one during the run. Finally, the
     OutputCSV class writes the data to the desired output file.
     """
-    headers = {'Content-Type':'application/json'}
-    """The headers needed to return usable data from the WormBase API"""
-
     GENE_BASE = "http://api.wormbase.org/rest/field/gene"
     """The API base URL for gene information"""
     
     PROTEIN_BASE= "http://api.wormbase.org/rest/field/protein"
     """The API base URL for protein information"""
-    
+
+    WIDGET_BASE = "http://api.wormbase.org/rest/widget/gene"
+    """The API base URL for gene widgets, which bundle several fields into one response"""
+
+    session = buildSession()
+    """The pooled HTTP session shared by all WormData objects"""
+
     def __init__ (self, dbId, geneID, database):
-        """Constructs a WormData object and kicks off the populate() method
+        """Constructs a WormData object
 
+        Construction is cheap: no API calls happen until populate() is called.
         populate() can take up to a few seconds, since it involves making multiple
-        calls to the WormBase API. Be careful about instantiating too many of these,
-        at once.
+        calls to the WormBase API, so batches of WormData objects should be
+        populated together through the module-level populateAll() driver.
 
         Arguments:
         xlocID -- the DB_ID parameter that corresponds to this item in the CuffLink database. This is only
@@ -143,7 +308,6 @@ class WormData ():
         self.dbId = dbId
         self.data['gene_id'] = geneID
         self.database = database
-        self.populate()
 
     def populate (self):
         """Populates the WormData object with all the desired data from WormBase
@@ -183,21 +347,44 @@ class WormData ():
             if self.dbId:
                 self.data['up/down'] = self.database.get(self.dbId)['log2(fold_change)']
 
-            # Most API calls will look like this. We call self.fetch and provide
-            # the base URL, unique ID, and endpoint. We get the results back in
-            # a JSON object and extract what we need from it
-            sequence = self.fetch(self.GENE_BASE, self.geneID, 'sequence_name')
+            # Most of the fields we need come bundled together in two of the
+            # WormBase widget endpoints: 'overview' carries sequence_name,
+            # concise_description and gene_class, and 'homology' carries the
+            # three ortholog tables. Two widget calls replace six per-field
+            # round trips. gene_models is not part of either widget, so it is
+            # still fetched on its own. The three requests are independent and
+            # go to the thread pool together
+            overview, homology, geneModels = executor.map(
+                lambda call: call(),
+                [lambda: self.fetch_widget('overview'),
+                 lambda: self.fetch_widget('homology'),
+                 lambda: self.fetch(self.GENE_BASE, self.geneID, 'gene_models')])
+
+            results = {}
+            results.update(overview)
+            results.update(homology)
+
+            # Any field the widgets did not cover falls back to its individual
+            # field endpoint, so a widget reshuffle on the server side cannot
+            # silently drop columns from the output
+            for endpoint in ['sequence_name', 'concise_description', 'gene_class',
+                             'human_orthologs', 'nematode_orthologs', 'other_orthologs']:
+                if results.get(endpoint) is None:
+                    results[endpoint] = self.fetch(self.GENE_BASE, self.geneID, endpoint)
+
+            # We get each result back in a JSON object and extract what we
+            # need from it
+            sequence = results['sequence_name']
             self.data['sequence_name'] = sequence
 
-            description = self.fetch(self.GENE_BASE, self.geneID, 'concise_description')
+            description = results['concise_description']
             self.data['description'] = description['text']
 
             # The gene_models endpoint will return a JSON array of proteins. We
             # must extract each protein ID and save it to the protein_id list
             # in the self.data dictionary. These protein IDs will be used
             # individually later on
-            geneModels = self.fetch(self.GENE_BASE, self.geneID, 'gene_models')
-            
+
             self.data['protein_id'] = []
             if geneModels and 'table' in geneModels:
                 for item in geneModels['table']:
@@ -205,86 +392,56 @@ class WormData ():
                         self.data['protein_id'].append(item['protein']['id'])
 
 
-            geneClass = self.fetch(self.GENE_BASE, self.geneID, 'gene_class')
+            geneClass = results['gene_class']
             if geneClass and 'tag' in geneClass and 'label' in geneClass['tag']:
                 self.data['gene_class'] = geneClass['tag']['label']
 
-            humanOrthologs = self.fetch(self.GENE_BASE, self.geneID, 'human_orthologs')
-            self.data['human_orthologs'] = []
-            if humanOrthologs:
-                for item in humanOrthologs:
-                    self.data['human_orthologs'].append(item['ortholog']['label'])
-
-            # For data elements that can have multiple values, we concatenate the values
-            # together. The convenience method self.joinIfExtant is provided for this use
-            self.joinIfExtant('human_orthologs')
-
-            nematodeOrthologs = self.fetch(self.GENE_BASE, self.geneID, 'nematode_orthologs')
-            self.data['nematode_orthologs'] = []
-            if nematodeOrthologs:
-                for item in nematodeOrthologs:
-                    self.data['nematode_orthologs'].append(item['ortholog']['label'])
-
-            self.joinIfExtant('nematode_orthologs')
-
-            otherOrthologs = self.fetch(self.GENE_BASE, self.geneID, 'other_orthologs')
-            self.data['other_orthologs'] = []
-            if otherOrthologs:
-                for item in otherOrthologs:
-                    self.data['other_orthologs'].append(item['ortholog']['label'])
-
-            self.joinIfExtant('other_orthologs')
+            # The three ortholog endpoints all return their matches in the
+            # same shape, so one helper extracts the labels for each. Values
+            # are concatenated with commas, or recorded as None when the
+            # endpoint returned no matches
+            for endpoint in ['human_orthologs', 'nematode_orthologs', 'other_orthologs']:
+                labels = self._collect_labels(results[endpoint])
+                self.data[endpoint] = ', '.join(labels) if labels else None
 
             self.data['best_human_ortholog'] = []
 
-            # We need to proceed differently depending on whether we have 1 protein_id
-            # or many. We want to perform a request to the API for each protein_id, but
-            # if we have only 1, the value self.data['protein_id'] will be a string (str)
-            # and the traditional loop structure
-            #
-            #     for x in self.data['protein_id']
-            #         ...
-            #
-            # will result in a loop that repeats for each character in the string self.data['protein_id']
-            # So if the protein_id data is a single str, we proceed one way. If it's not, that means
-            # it must be a list, and we proceed another.
-            isSingular = isinstance(self.data['protein_id'], str)
-
             # best_human_ortholog takes no small amount of effort to extract. For
             # each protein_id collected earlier, we access that protein's endpoint
             # in the WormBase API. The information we're looking for, the description
             # of the best human ortholog is buried in several layers of JSON strata,
-            # making this section hard to read at best.
-            if self.data['protein_id'] and not isSingular:
-                for proteinID in self.data['protein_id']:
-                    bestHumanMatch = self.fetch(self.PROTEIN_BASE, proteinID, 'best_human_match')
+            # making this section hard to read at best. protein_id stays a list
+            # right up until it is written into self.data below, so there is no
+            # single-protein special case: the per-protein lookups all go to the
+            # thread pool together, just like the gene endpoints above
+            if self.data['protein_id']:
+                bestHumanMatches = executor.map(
+                    lambda proteinID: self.fetch(self.PROTEIN_BASE, proteinID, 'best_human_match'),
+                    self.data['protein_id'])
+                for bestHumanMatch in bestHumanMatches:
                     if bestHumanMatch and 'description' in bestHumanMatch:
                         self.data['best_human_ortholog'].append(bestHumanMatch['description'])
-            elif self.data['protein_id']:
-                bestHumanMatch = self.fetch(self.PROTEIN_BASE, self.data['protein_id'], 'best_human_match')
-                if bestHumanMatch and 'description' in bestHumanMatch:
-                    self.data['best_human_ortholog'].append(bestHumanMatch['description'])
 
+            # Multi-valued data is flattened to a comma-separated string (or
+            # None when there were no values) only now, at the very end
+            self.data['protein_id'] = ', '.join(self.data['protein_id']) or None
+            self.data['best_human_ortholog'] = ', '.join(self.data['best_human_ortholog']) or None
 
-            self.joinIfExtant('protein_id')
-            self.joinIfExtant('best_human_ortholog')
+    def _collect_labels (self, orthologs):
+        """Extracts the display label from each entry in an ortholog table
 
-    def joinIfExtant (self, datum):
-        """Convenience method that joins all values in a list with a comma, if there are values in that list
+        Every ortholog endpoint returns its matches in the same shape, so this
+        helper replaces the extraction loop that used to be copied after each
+        of the three ortholog fetches in populate().
 
         Arguments:
-        datum -- list of strings to be joined. 'datum' is used as the name because in this module, the values
-        that will be passed in represent the results from one call to the WormBase API
+        orthologs -- the fetched data from one of the ortholog endpoints
 
         Return:
-        a comma-separated string of all values in datum
+        a list of the ortholog labels, empty if the endpoint returned nothing
         """
-        
-        if len(self.data[datum]) == 0:
-            self.data[datum] = None
-        else:
-            self.data[datum] = ', '.join(self.data[datum])
-        
+        return [item['ortholog']['label'] for item in orthologs] if orthologs else []
+
     def get (self, datum):
         """Public access to the data stored in self.data
 
@@ -303,6 +460,62 @@ class WormData ():
         """Returns the entirety of self.data"""
         return self.data
 
+    def as_row (self, headers):
+        """Projects self.data into a tuple ordered to match `headers`
+
+        Building the row once here means OutputCSV can hand the whole batch
+        straight to csv.writer.writerows instead of paying a dict lookup per
+        header per row at write time.
+
+        Arguments:
+        headers -- the column names, in output order
+
+        Return:
+        a tuple with one entry per header; None for headers with no data
+        """
+        return tuple(self.data.get(h) for h in headers)
+
+
+    def fetch_widget (self, widget):
+        """Makes an HTTP GET request for a whole WormBase gene widget
+
+        Widgets bundle several of the per-field gene endpoints into a single
+        response, so one widget call costs one round trip where the individual
+        field endpoints would cost one each.
+
+        Arguments:
+        widget -- the name of the widget to fetch, e.g. 'overview'
+
+        Return:
+        a dict mapping each field name in the widget to that field's 'data'
+        payload, the same shape fetch() returns for a single field. An empty
+        dict if the widget could not be fetched
+        """
+        url = f"{self.WIDGET_BASE}/{self.geneID}/{widget}"
+
+        cached = cacheGet(url)
+        if cached is not None:
+            return cached
+
+        with self.session.get(url, timeout=(3.05, 30)) as r:
+            if r.status_code != 200:
+                return {}
+
+            try:
+                j = parseJson(r.content)
+            except ValueError:
+                return {}
+
+        # A widget response wraps its fields in a 'fields' key; each field
+        # has the same {'data': ...} shape as the per-field endpoints
+        fields = j.get('fields')
+        if not fields:
+            return {}
+
+        result = {name: field.get('data') for name, field in fields.items()}
+        cachePut(url, result)
+        return result
+
     def fetch (self, baseUrl, id, datum):
         """Makes an HTTP GET request to the WormBase RESTful API
 
@@ -311,21 +524,42 @@ class WormData ():
         id -- the WormBase ID of the gene or protein for lookup
         datum -- the specific endpoint that will be accessed
         """
-        r = requests.get(baseUrl + '/' + id + '/' + datum, headers=self.headers)
-
-        # We must manipulate the data in JSON format. We try to get the JSON form
-        # of the response to the request. If it doesn't work, return None
-        try:
-            j = r.json()
-        except:
-            return None
+        url = f"{baseUrl}/{id}/{datum}"
+
+        # WormBase data changes very slowly compared to how often WormBait is
+        # run, so repeated lookups of the same URL are answered from the cache
+        # instead of going back out over the network
+        cached = cacheGet(url)
+        if cached is not None:
+            return cached
+
+        # The context manager hands the pooled connection back promptly once
+        # the body has been read
+        with self.session.get(url, timeout=(3.05, 30)) as r:
+
+            # A non-200 response carries an HTML error page rather than JSON,
+            # so there is no point paying for a parse that is going to fail
+            if r.status_code != 200:
+                return None
+
+            # We must manipulate the data in JSON format. We try to get the JSON form
+            # of the response to the request. If it doesn't work, return None.
+            # ValueError is what a failed JSON decode raises; the old bare
+            # except also swallowed things like KeyboardInterrupt
+            try:
+                j = parseJson(r.content)
+            except ValueError:
+                return None
 
         # WormBase provides a decent amount of ancillary data when returning from
         # its API. We are not interested in anything outside of the 'data' key
         # in the returned JSON object, so we extract it here. If there is no 'data'
         # in the JSON object, return None
         if datum in j and 'data' in j[datum]:
-            return j[datum]['data']
+            result = j[datum]['data']
+            if result is not None:
+                cachePut(url, result)
+            return result
         else:
             return None
         